@@ -0,0 +1,238 @@
+/*
+ * C implementation of elasticsearch_replay.replay_parser.scan_records
+ *
+ * Walks the replay log buffer line by line and builds request line, request
+ * body, status line and response body of every record closed with END marker
+ * line. Lines may end with CRLF.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define PyInt_FromLong PyLong_FromLong
+#endif
+
+
+typedef struct {
+    const char *start;
+    Py_ssize_t len;
+} line_t;
+
+/* Lines of request or response part of a record */
+typedef struct {
+    line_t *lines;
+    Py_ssize_t count;
+    Py_ssize_t size;
+} section_t;
+
+static int
+section_append(section_t *section, const char *start, Py_ssize_t len)
+{
+    line_t *lines;
+    Py_ssize_t size;
+
+    if (section->count == section->size) {
+        size = section->size ? section->size * 2 : 8;
+        lines = PyMem_Realloc(section->lines, size * sizeof(line_t));
+        if (lines == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        section->lines = lines;
+        section->size = size;
+    }
+    section->lines[section->count].start = start;
+    section->lines[section->count].len = len;
+    section->count++;
+    return 0;
+}
+
+/* Returns int for line of ASCII digits, NULL without exception otherwise */
+static PyObject *
+line_as_int(line_t *line)
+{
+    Py_ssize_t i;
+    long value = 0;
+
+    /* status codes are short, longer lines are left for int() */
+    if (line->len == 0 || line->len > 9)
+        return NULL;
+    for (i = 0; i < line->len; i++) {
+        if (line->start[i] < '0' || line->start[i] > '9')
+            return NULL;
+        value = value * 10 + (line->start[i] - '0');
+    }
+    return PyInt_FromLong(value);
+}
+
+/*
+ * Sets head to the first line (None if there are no lines) and tail to the
+ * remaining lines joined with newlines, both copied from the buffer once.
+ * With numeric set head made of digits only is converted to int.
+ */
+static int
+section_fields(section_t *section, PyObject **head, PyObject **tail,
+               int numeric)
+{
+    Py_ssize_t i, size = 0;
+    char *p;
+
+    if (section->count == 0) {
+        Py_INCREF(Py_None);
+        *head = Py_None;
+        *tail = PyBytes_FromStringAndSize("", 0);
+        return *tail == NULL ? -1 : 0;
+    }
+
+    *head = numeric ? line_as_int(&section->lines[0]) : NULL;
+    if (*head == NULL && !PyErr_Occurred())
+        *head = PyBytes_FromStringAndSize(section->lines[0].start,
+                                          section->lines[0].len);
+    if (*head == NULL)
+        return -1;
+
+    for (i = 1; i < section->count; i++)
+        size += section->lines[i].len + 1;
+    *tail = PyBytes_FromStringAndSize(NULL, size ? size - 1 : 0);
+    if (*tail == NULL) {
+        Py_CLEAR(*head);
+        return -1;
+    }
+    p = PyBytes_AS_STRING(*tail);
+    for (i = 1; i < section->count; i++) {
+        if (i > 1)
+            *p++ = '\n';
+        memcpy(p, section->lines[i].start, section->lines[i].len);
+        p += section->lines[i].len;
+    }
+    return 0;
+}
+
+static PyObject *
+make_record(section_t *req, section_t *resp)
+{
+    PyObject *fields[4], *record;
+    int i;
+
+    if (section_fields(req, &fields[0], &fields[1], 0) < 0)
+        return NULL;
+    if (section_fields(resp, &fields[2], &fields[3], 1) < 0) {
+        Py_DECREF(fields[0]);
+        Py_DECREF(fields[1]);
+        return NULL;
+    }
+
+    record = PyTuple_New(4);
+    for (i = 0; i < 4; i++) {
+        if (record == NULL)
+            Py_DECREF(fields[i]);
+        else
+            PyTuple_SET_ITEM(record, i, fields[i]);
+    }
+    return record;
+}
+
+static PyObject *
+scan_records(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    const char *pos, *eol, *end;
+    Py_ssize_t len;
+    PyObject *buf, *records, *record;
+    section_t req = {NULL, 0, 0}, resp = {NULL, 0, 0};
+
+    if (!PyArg_ParseTuple(args, "O:scan_records", &buf))
+        return NULL;
+    /* "s*" would silently encode unicode with the default encoding */
+    if (PyUnicode_Check(buf)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "scan_records() argument must be bytes or buffer, "
+                        "not unicode");
+        return NULL;
+    }
+    if (!PyArg_Parse(buf, "s*:scan_records", &view))
+        return NULL;
+
+    records = PyList_New(0);
+    if (records == NULL)
+        goto error;
+
+    pos = (const char *)view.buf;
+    end = pos + view.len;
+    while (pos < end) {
+        eol = memchr(pos, '\n', end - pos);
+        if (eol == NULL)
+            break;  /* unterminated line can't close a record */
+        len = eol - pos;
+        if (len > 0 && pos[len - 1] == '\r')
+            len--;  /* CRLF line ending */
+
+        if (len == 2 && pos[0] == '#' && pos[1] == '#') {
+            /* END marker */
+            record = make_record(&req, &resp);
+            if (record == NULL)
+                goto error;
+            if (PyList_Append(records, record) < 0) {
+                Py_DECREF(record);
+                goto error;
+            }
+            Py_DECREF(record);
+            req.count = resp.count = 0;
+        }
+        else if (len >= 3 && pos[0] == '#' && pos[2] == ' ') {
+            /* IN and OUT markers */
+            if (pos[1] == '>' && section_append(&req, pos + 3, len - 3) < 0)
+                goto error;
+            if (pos[1] == '<' && section_append(&resp, pos + 3, len - 3) < 0)
+                goto error;
+        }
+        pos = eol + 1;
+    }
+
+    PyMem_Free(req.lines);
+    PyMem_Free(resp.lines);
+    PyBuffer_Release(&view);
+    return records;
+
+error:
+    PyMem_Free(req.lines);
+    PyMem_Free(resp.lines);
+    Py_XDECREF(records);
+    PyBuffer_Release(&view);
+    return NULL;
+}
+
+PyDoc_STRVAR(scan_records_doc,
+"scan_records(buf) -> list\n\
+\n\
+Returns (request line, body, status line, response) tuple for every\n\
+complete record in replay log bytes or buffer. Status line of digits is\n\
+returned as int.");
+
+static PyMethodDef replay_parser_methods[] = {
+    {"scan_records", scan_records, METH_VARARGS, scan_records_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef replay_parser_module = {
+    PyModuleDef_HEAD_INIT,
+    "_replay_parser",
+    NULL,
+    -1,
+    replay_parser_methods
+};
+
+PyMODINIT_FUNC
+PyInit__replay_parser(void)
+{
+    return PyModule_Create(&replay_parser_module);
+}
+#else
+PyMODINIT_FUNC
+init_replay_parser(void)
+{
+    Py_InitModule("_replay_parser", replay_parser_methods);
+}
+#endif
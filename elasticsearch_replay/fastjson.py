@@ -0,0 +1,43 @@
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.compat import string_types
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    JSONSerializer using ujson when available. Anything ujson can't handle
+    (eg. big integers, NaN, types needing `default` or byte strings which
+    aren't valid UTF-8) is passed to the stdlib based implementation, which
+    raises the same errors as the elasticsearch one.
+
+    Unlike the stdlib, ujson also serializes objects with `__json__` or
+    `toDict` method instead of raising SerializationError.
+    """
+
+    def loads(self, s):
+        if ujson is not None:
+            try:
+                return ujson.loads(s)
+            except (ValueError, TypeError, OverflowError):
+                pass
+        return super(FastJSONSerializer, self).loads(s)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, string_types):
+            return data
+
+        if ujson is not None:
+            try:
+                rv = ujson.dumps(data, escape_forward_slashes=False)
+                # Output is escaped to ASCII, other bytes are copied from
+                # strings the stdlib can't decode
+                rv.decode('ascii')
+                return rv
+            except (ValueError, TypeError, OverflowError):
+                pass
+        return super(FastJSONSerializer, self).dumps(data)
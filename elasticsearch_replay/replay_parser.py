@@ -0,0 +1,66 @@
+"""
+Replay log format.
+
+Every recorded request is stored as lines prefixed with IN marker (request
+line followed by request body lines), lines prefixed with OUT marker (status
+line followed by response body lines) and END marker line closing the record.
+Lines may end with CRLF (eg. logs recorded in text mode on Windows).
+"""
+
+# Markers
+IN = '#> '
+OUT = '#< '
+END = '##\n'
+
+# Markers encoded once for writing the binary replay log
+IN_B = b'#> '
+OUT_B = b'#< '
+END_B = b'##\n'
+IN_PREFIX_NL = b'\n' + IN_B
+OUT_PREFIX_NL = b'\n' + OUT_B
+END_PREFIX_NL = b'\n' + END_B
+
+
+def py_scan_records(buf):
+    """
+    Yields (request line, body, status line, response) tuple for every
+    complete record in replay log buffer. Request and status lines are None
+    if missing, body and response lines are joined with newlines. The C
+    implementation returns status line made of digits as int.
+    """
+    if buf.find('\r\n') != -1:
+        buf = buf[:].replace('\r\n', '\n')
+
+    # END marker always takes a whole line, anything after the last one
+    # is an incomplete record
+    sep = '\n' + END
+    start = 0
+    while True:
+        if buf[start:start + len(END)] == END:
+            # Empty record, no newline precedes the marker
+            end = start
+            next_start = start + len(END)
+        else:
+            end = buf.find(sep, start)
+            if end == -1:
+                break
+            next_start = end + len(sep)
+
+        req = []
+        resp = []
+        dispatch = {IN: req.append, OUT: resp.append}
+        for line in buf[start:end].split('\n'):
+            append = dispatch.get(line[:3])
+            if append is not None:
+                append(line[3:])
+        yield (req[0] if req else None, '\n'.join(req[1:]),
+               resp[0] if resp else None, '\n'.join(resp[1:]))
+
+        start = next_start
+
+
+scan_records = py_scan_records
+try:
+    from ._replay_parser import scan_records
+except ImportError:
+    pass
@@ -1,19 +1,82 @@
+import atexit
+import io
 import logging
-from urllib import urlencode
+import mmap
+import os
+import re
+import stat
+import weakref
+from urllib import quote_plus
 
 from elasticsearch.transport import Transport
 from elasticsearch.exceptions import TransportError, SerializationError
 
 from .exceptions import RequestMatchError, ReplayLogExceededError, \
         ReplayFileParseError
+from .fastjson import FastJSONSerializer
+# IN, OUT and END markers are kept importable from here
+from .replay_parser import IN, OUT, END, IN_B, OUT_B, END_B, \
+        IN_PREFIX_NL, OUT_PREFIX_NL, END_PREFIX_NL, scan_records  # noqa
 
 
 logger = logging.getLogger('elasticsearch.replay')
 
-# Markers
-IN = '#> '
-OUT = '#< '
-END = '##\n'
+
+_NOT_PARSED = object()
+
+# File objects whose descriptor exposes their contents as is
+OS_FILE_TYPES = (file, io.FileIO, io.BufferedReader, io.BufferedRandom)
+
+# RecordTransports buffering requests, weak so they can still be collected
+_buffered_transports = weakref.WeakSet()
+
+
+def flush_buffered_transports():
+    for transport in list(_buffered_transports):
+        transport.flush()
+
+
+atexit.register(flush_buffered_transports)
+
+# Characters never escaped by quote_plus
+_is_safe = re.compile(r'[A-Za-z0-9_.\-]*\Z').match
+
+
+def to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def fast_urlencode(params):
+    """
+    Same as urllib.urlencode but quotes only keys and values that need it,
+    which for typical elasticsearch params means none of them
+    """
+    parts = []
+    for key, value in params.items():
+        key = str(key)
+        value = str(value)
+        if not _is_safe(key):
+            key = quote_plus(key)
+        if not _is_safe(value):
+            value = quote_plus(value)
+        parts.append(key + '=' + value)
+    return '&'.join(parts)
+
+
+class LazyJSON(object):
+    """Serialized data deserialized on first access"""
+
+    __slots__ = ('raw', 'loads', '_value')
+
+    def __init__(self, raw, loads):
+        self.raw = raw
+        self.loads = loads
+        self._value = _NOT_PARSED
+
+    def value(self):
+        if self._value is _NOT_PARSED:
+            self._value = self.loads(self.raw)
+        return self._value
 
 
 class RecordTransport(Transport):
@@ -21,31 +84,60 @@ class RecordTransport(Transport):
     def __init__(self, *args, **kwargs):
         recfile = kwargs.pop('recfile', None)
         self.recfile = self.prepare_output_file(recfile)
+        # Number of recorded requests buffered before the file is flushed
+        self._flush_every = kwargs.pop('flush_every', 1)
+        self._flush_counter = 0
+        if self._flush_every > 1:
+            _buffered_transports.add(self)
+        kwargs.setdefault('serializer', FastJSONSerializer())
         super(RecordTransport, self).__init__(*args, **kwargs)
+        self._dumps = self.serializer.dumps
 
     def prepare_output_file(self, path):
         if isinstance(path, basestring):
-            return open(path, 'w') if path else None
+            return open(path, 'wb') if path else None
         else:
             return path
 
+    def flush(self):
+        """Flush requests buffered in the replay log"""
+        self._flush_counter = 0
+        if self.recfile and not getattr(self.recfile, 'closed', False):
+            self.recfile.flush()
+
     def format_request(self, method, url, params, body):
         """Format single request info"""
         # Serialize request body
-        body = self.serializer.dumps(body) if body else None
-
-        out_body = ('\n%s' % IN).join(body.split('\n')) if body else '-'
-        out_params = urlencode(params) if params else '-'
-        output = "%s%s %s %s\n%s%s\n" % (IN, method, url, out_params, IN,
-                                         out_body)
-        return output
+        body = self._dumps(body) if body else None
+
+        buf = bytearray(IN_B)
+        buf += to_bytes(method)
+        buf += b' '
+        buf += to_bytes(url)
+        buf += b' '
+        buf += to_bytes(fast_urlencode(params)) if params else b'-'
+        buf += IN_PREFIX_NL
+        if not body:
+            buf += b'-'
+        elif '\n' not in body:
+            buf += to_bytes(body)
+        else:
+            buf += to_bytes(body).replace(b'\n', IN_PREFIX_NL)
+        buf += b'\n'
+        return bytes(buf)
 
     def format_response(self, status, body):
         "Format single response info"
-        body = self.serializer.dumps(body)
-        out_body = ('\n%s' % OUT).join(body.split('\n')) if body else '-'
-        output = "%s%s\n%s%s\n" % (OUT, status, OUT, out_body)
-        return output
+        body = self._dumps(body)
+        if not body:
+            out_body = b'-'
+        elif '\n' not in body:
+            # Usual single line JSON
+            out_body = body
+        else:
+            out_body = body.replace(b'\n', OUT_PREFIX_NL)
+        output = b"%s%s\n%s%s\n" % (OUT_B, status, OUT_B, out_body)
+        return to_bytes(output)
 
     def perform_request(self, method, url, params=None, body=None):
         exception = None
@@ -60,19 +152,16 @@ class RecordTransport(Transport):
 
         if self.recfile:
             try:
-                # Store request
+                # Request, response and single request end marker are
+                # written at once
                 req = self.format_request(method, url, params, body)
-                self.recfile.write(req)
-
-                # Store response
                 resp = self.format_response(status, data)
-                self.recfile.write(resp)
-
-                # Store single request end marker
-                end_mark = "%s%s" % ('' if resp.endswith('\n') else '\n', END)
-                self.recfile.write(end_mark)
+                end_mark = END_B if resp.endswith(b'\n') else END_PREFIX_NL
+                self.recfile.writelines([req, resp, end_mark])
 
-                self.recfile.flush()
+                self._flush_counter += 1
+                if self._flush_counter >= self._flush_every:
+                    self.flush()
             except Exception:
                 logger.exception('Unable to record request')
 
@@ -87,90 +176,163 @@ class ReplayTransport(Transport):
     def __init__(self, *args, **kwargs):
         recfile = kwargs.pop('recfile', None)
         self.recfile = self.prepare_output_file(recfile)
-        self.reset_replay_log()
+        # Only a log opened here can't be rewritten through another file object
+        self._owns_recfile = isinstance(recfile, basestring)
+        kwargs.setdefault('serializer', FastJSONSerializer())
         super(ReplayTransport, self).__init__(*args, **kwargs)
+        self._dumps = self.serializer.dumps
+        self._loads = self.deserializer.loads
+        self._replay_log_stamp = None
+        self.reset_replay_log()
 
     def reset_replay_log(self):
+        # Records already parsed are replayed again unless the file changed
+        stamp = self.get_replay_log_stamp()
+        if stamp is None or stamp != self._replay_log_stamp:
+            self._replay_log_stamp = stamp
+            self.load_replay_records()
+        self._replay_index = 0
+
+    def load_replay_records(self):
+        self._replay_records = []
+        self._replay_error = None
         self.recfile.seek(0)
-        self.replay_iterator = self.create_replay_iterator()
+        try:
+            for record in self.create_replay_iterator():
+                self._replay_records.append(record)
+        except Exception as e:
+            # Raised once replay gets to the broken record
+            self._replay_error = e
+
+    def get_replay_log_fileno(self):
+        """
+        Returns descriptor of replay file if it's a regular OS file, None
+        otherwise (eg. in-memory or compressed file objects)
+        """
+        if not isinstance(self.recfile, OS_FILE_TYPES):
+            return None
+        try:
+            fileno = self.recfile.fileno()
+        except (IOError, ValueError):
+            return None
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return None
+
+        # Replay log may be shared with a RecordTransport
+        self.recfile.flush()
+        return fileno
+
+    def get_replay_log_stamp(self):
+        """
+        Returns value which changes with replay file contents, None when it
+        can't be determined (eg. file objects passed by caller, which may be
+        rewritten at the same size within mtime resolution)
+        """
+        if not self._owns_recfile:
+            return None
+        fileno = self.get_replay_log_fileno()
+        if fileno is None:
+            return None
+
+        file_stat = os.fstat(fileno)
+        return file_stat.st_size, file_stat.st_mtime
 
     def prepare_output_file(self, path):
         if isinstance(path, basestring):
-            return open(path, 'r') if path else None
+            return open(path, 'rb') if path else None
         else:
             return path
 
-    def get_whole_request_info(self, req, resp):
-        method, url, params = req[0].split(' ')
-        body = '\n'.join(req[1:])
-        status = resp[0]
-        response = '\n'.join(resp[1:])
+    def get_whole_request_info(self, request, body, status, response):
+        method, url, params = request.split(' ')
+        body = body.rstrip('\n')
+        status = int(status)
+        response = response.rstrip('\n')
 
-        deserialized = body
-        if deserialized != '-\n':
-            try:
-                deserialized = self.deserializer.loads(body)
-            except SerializationError:
-                pass
-
-        retval = {
+        return {
             'method': method,
             'url': url,
             'params': params,
-            'body': deserialized,
+            'body': LazyJSON(body, self.deserialize_body),
             'status': status,
             'response': response,
         }
-        for key, value in retval.items():
-            if isinstance(value, basestring):
-                retval[key] = value.rstrip('\n')
 
-        retval['status'] = int(retval['status'])
-        return retval
+    def deserialize_body(self, body):
+        """
+        Returns request body deserialized if it looks like JSON object or
+        array, as is otherwise
+        """
+        if body.lstrip()[:1] not in ('{', '['):
+            return body
+        try:
+            return self._loads(body)
+        except SerializationError:
+            return body
+
+    def read_replay_log(self):
+        """
+        Returns replay file contents, memory mapped when the file supports it
+        """
+        fileno = self.get_replay_log_fileno()
+        if fileno is None:
+            # Text file objects are scanned as UTF-8 like binary ones
+            return to_bytes(self.recfile.read())
+
+        if not os.fstat(fileno).st_size:
+            return ''
+        self.recfile.seek(0, os.SEEK_END)
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
 
     def create_replay_iterator(self):
         """
         Returns iterator which yields request/response dicts from replay file
         """
-        req = []
-        resp = []
-        for line in self.recfile:
-            if line == END:
-                yield self.get_whole_request_info(req, resp)
-                req, resp = [], []
-            elif line.startswith(IN):
-                req.append(line[3:])
-            elif line.startswith(OUT):
-                resp.append(line[3:])
+        buf = self.read_replay_log()
+        for record in scan_records(buf):
+            yield self.get_whole_request_info(*record)
+
+    def log_mismatch(self, value, replay_value):
+        logger.error('Request match error %s != %s',
+                     repr(value), repr(replay_value))
+        return False
 
     def check_match(self, replay, current):
-        for key, value in current.items():
-            if value != replay[key]:
-                logger.error('Request match error %s != %s',
-                             repr(value), repr(replay[key]))
-                return False
+        # Fields ordered by selectivity, most mismatches fail on the first one
+        if current['method'] != replay['method']:
+            return self.log_mismatch(current['method'], replay['method'])
+        if current['url'] != replay['url']:
+            return self.log_mismatch(current['url'], replay['url'])
+        if current['params'] != replay['params']:
+            return self.log_mismatch(current['params'], replay['params'])
+        if current['body'] != replay['body'].value():
+            return self.log_mismatch(current['body'], replay['body'].value())
 
         return True
 
     def get_next_replay(self, method, url, params, body):
         try:
-            data = self.replay_iterator.next()
-        except StopIteration:
+            data = self._replay_records[self._replay_index]
+        except IndexError:
+            if self._replay_error is not None:
+                raise ReplayFileParseError('Error parsing replay file: %s',
+                                           self._replay_error)
             raise ReplayLogExceededError('No more entries in replay log')
-        except Exception as e:
-            raise ReplayFileParseError('Error parsing replay file: %s', e)
+        self._replay_index += 1
 
         current = {
             'method': method,
             'url': url,
-            'params': urlencode(params) if params else '-',
+            'params': fast_urlencode(params) if params else '-',
             'body': body if body else '-',
         }
         if not self.check_match(data, current):
             raise RequestMatchError("Current request doesn't match a replay"
                                     "data")
 
-        return data['status'], self.deserializer.loads(data['response'])
+        # Parsed on every replay, so callers never share a response object
+        # across replay log resets
+        return data['status'], self._loads(data['response'])
 
     def perform_request(self, method, url, params=None, body=None):
         # The fun with serialization and deserialization below is due to the
@@ -178,12 +340,12 @@ class ReplayTransport(Transport):
         # the request body here to the same process as the recorded one (first
         # it's serialized in RecordTransport and later deserialized in
         # ReplayTransport)
-        body = self.serializer.dumps(body)
-        if body and isinstance(body, basestring):
-            try:
-                body = self.deserializer.loads(body)
-            except SerializationError:
-                pass
+        # Falsy bodies are recorded as '-' just like missing ones
+        if body:
+            # Strings are passed as is by the serializer
+            if not isinstance(body, basestring):
+                body = self._dumps(body)
+            body = self.deserialize_body(body)
         status, data = self.get_next_replay(method, url, params, body)
 
         # Support for exeptions
@@ -1,9 +1,34 @@
 import os
-from setuptools import setup
+from distutils.errors import CCompilerError, DistutilsExecError, \
+        DistutilsPlatformError
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
 
 README = open(os.path.join(os.path.dirname(__file__), 'README.rst')).read()
 with open('requirements.txt', 'r') as x:
-    REQUIREMENTS = filter(None, x.read().split('\n'))
+    lines = (line.strip() for line in x.read().splitlines())
+    REQUIREMENTS = [line for line in lines
+                    if line and not line.startswith('#')]
+
+
+class optional_build_ext(build_ext):
+    """Skips C extensions which can't be built, pure Python is used instead"""
+
+    errors = (CCompilerError, DistutilsExecError, DistutilsPlatformError,
+              IOError)
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except self.errors as e:
+            self.warn('Unable to build C extensions: %s' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except self.errors as e:
+            self.warn('Unable to build %s: %s' % (ext.name, e))
+
 
 # allow setup.py to be run from any path
 os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
@@ -12,6 +37,11 @@ setup(
     name='elasticsearch-replay',
     version='0.1',
     packages=['elasticsearch_replay'],
+    ext_modules=[
+        Extension('elasticsearch_replay._replay_parser',
+                  ['elasticsearch_replay/_replay_parser.c']),
+    ],
+    cmdclass={'build_ext': optional_build_ext},
     include_package_data=True,
     license='BSD License',  # example license
     description='Record and replay elasticsearch communication',
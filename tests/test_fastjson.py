@@ -0,0 +1,61 @@
+import datetime
+import math
+import unittest
+
+from elasticsearch.exceptions import SerializationError
+
+from elasticsearch_replay.fastjson import FastJSONSerializer, ujson
+
+
+class FastJSONSerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.s = FastJSONSerializer()
+
+    def test_strings_are_not_serialized(self):
+        assert self.s.dumps('{"key": "value"}') == '{"key": "value"}'
+
+    def test_round_trip(self):
+        data = {'key': 'value', 'list': [1, 2.5, None, True]}
+        assert self.s.loads(self.s.dumps(data)) == data
+
+    def test_datetime_serialized_as_isoformat(self):
+        rv = self.s.dumps({'date': datetime.datetime(2014, 7, 1, 0, 0)})
+        assert self.s.loads(rv) == {'date': '2014-07-01T00:00:00'}
+
+    def test_big_integer(self):
+        rv = self.s.loads('{"n": 123456789012345678901234567890}')
+        assert rv == {'n': 123456789012345678901234567890}
+
+    def test_nan_round_trip(self):
+        rv = self.s.loads(self.s.dumps({'n': float('nan')}))
+        assert math.isnan(rv['n'])
+
+    def test_not_serializable(self):
+        with self.assertRaises(SerializationError):
+            self.s.dumps({'key': object()})
+
+    def test_not_deserializable(self):
+        with self.assertRaises(SerializationError):
+            self.s.loads('c2NhbjswOzE7dG90YWxfaGl0czoxMDA7')
+
+    def test_invalid_utf8_not_serializable(self):
+        with self.assertRaises(SerializationError):
+            self.s.dumps({'key': '\xff'})
+        with self.assertRaises(SerializationError):
+            self.s.dumps({'\xff': 'value'})
+
+    def test_utf8_round_trip(self):
+        rv = self.s.loads(self.s.dumps({'key': 'caf\xc3\xa9'}))
+        assert rv == {'key': u'caf\xe9'}
+
+    def test_json_methods_used_by_ujson(self):
+        class Document(object):
+            def toDict(self):
+                return {'key': 'value'}
+        if ujson is None:
+            with self.assertRaises(SerializationError):
+                self.s.dumps([Document()])
+        else:
+            assert self.s.loads(self.s.dumps([Document()])) == \
+                [{'key': 'value'}]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import io
+import mmap
+import os
+import unittest
+
+import mock
+
+from elasticsearch_replay.replay_parser import py_scan_records
+from elasticsearch_replay.transport import ReplayTransport
+try:
+    from elasticsearch_replay._replay_parser import scan_records
+except ImportError:
+    scan_records = None
+
+
+LOG = """#> GET /myindex -
+#> -
+#< 200
+#< {"key": "value"}
+##
+not a record line
+#> POST /_search/scroll scroll=5m
+#> c2Nhbj##
+#> 
+#< 200
+#< {"key":
+#< "value"}
+##
+##
+#> GET /incomplete -
+"""
+
+
+class PyScanRecordsTestCase(unittest.TestCase):
+
+    status = '200'
+
+    def scan(self, buf):
+        return list(py_scan_records(buf))
+
+    def test_records(self):
+        assert self.scan(LOG) == [
+            ('GET /myindex -', '-', self.status, '{"key": "value"}'),
+            ('POST /_search/scroll scroll=5m', 'c2Nhbj##\n', self.status,
+             '{"key":\n"value"}'),
+            (None, '', None, ''),
+        ]
+
+    def test_crlf_line_endings(self):
+        assert self.scan(LOG.replace('\n', '\r\n')) == self.scan(LOG)
+
+    def test_crlf_mmap(self):
+        f = os.tmpfile()
+        f.write(LOG.replace('\n', '\r\n'))
+        f.flush()
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.scan(buf) == self.scan(LOG)
+
+    def test_empty(self):
+        assert self.scan('') == []
+
+    def test_starts_with_end_marker(self):
+        assert self.scan('##\n#> GET / -\n##\n') == [
+            (None, '', None, ''), ('GET / -', '', None, '')
+        ]
+
+    def test_unterminated_end_marker(self):
+        assert self.scan('#> GET / -\n##') == []
+
+    def test_status_line(self):
+        for status in ('404', ' 200', '2000000000'):
+            rv = self.scan('#> GET / -\n#< %s\n##\n' % status)
+            assert int(rv[0][2]) == int(status)
+
+    def test_unicode_replay_log(self):
+        f = io.StringIO(u'#> GET /_search -\n#> {"q": "café"}\n'
+                        u'#< 200\n#< {"key": "café"}\n##\n')
+        with mock.patch('elasticsearch_replay.transport.scan_records',
+                        self.scan):
+            t = ReplayTransport([{}], recfile=f)
+        status, data = t.get_next_replay('GET', '/_search', None,
+                                         {u'q': u'café'})
+        assert {u'key': u'café'} == data
+
+    def test_mmap(self):
+        f = os.tmpfile()
+        f.write(LOG)
+        f.flush()
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.scan(buf) == self.scan(LOG)
+
+
+@unittest.skipIf(scan_records is None, 'C extension not built')
+class CScanRecordsTestCase(PyScanRecordsTestCase):
+
+    status = 200
+
+    def scan(self, buf):
+        return scan_records(buf)
+
+    def test_unicode_rejected(self):
+        with self.assertRaises(TypeError):
+            scan_records(u'#> GET / -\n##\n')
@@ -1,12 +1,17 @@
+import gc
+import gzip
 import os
 import StringIO
 import unittest
+import urllib
+import weakref
 
 import mock
 
 from elasticsearch_replay.transport import RecordTransport, ReplayTransport, \
         IN, OUT, END, ReplayLogExceededError, ReplayFileParseError, \
-        RequestMatchError
+        RequestMatchError, fast_urlencode, LazyJSON, \
+        flush_buffered_transports, _buffered_transports
 import elasticsearch
 
 
@@ -54,6 +59,22 @@ class DummyConnection(elasticsearch.Connection):
         return status, {}, data
 
 
+def test_fast_urlencode_same_as_urlencode():
+    for params in ({'size': 10, 'from': 0, 'timeout': '30s'},
+                   {'q': 'field:a b&c', 'x y': u'z', 'f': 1.5, 'b': True},
+                   {'source': '{"query": {}}'}):
+        assert fast_urlencode(params) == urllib.urlencode(params)
+
+
+def test_lazy_json_parsed_once_on_access():
+    loads = mock.Mock(return_value={'key': 'value'})
+    data = LazyJSON('{"key": "value"}', loads)
+    assert not loads.called
+    assert data.value() == {'key': 'value'}
+    assert data.value() == {'key': 'value'}
+    loads.assert_called_once_with('{"key": "value"}')
+
+
 class RecordTransportTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -96,10 +117,19 @@ class RecordTransportTestCase(unittest.TestCase):
         assert '#< {"key": "value"}' == lines[1]
         assert '' == lines[2]  # ensure all ends with a newline
 
+    def test_format_response_multiline(self):
+        rv = self.t.format_response(200, '{"key":\n"value"}')
+        assert rv == '#< 200\n#< {"key":\n#< "value"}\n'
+
+    def test_format_response_unicode_body(self):
+        rv = self.t.format_response(200, u'{"key": "caf\xe9"}')
+        assert isinstance(rv, bytes)
+        assert rv == '#< 200\n#< {"key": "caf\xc3\xa9"}\n'
+
     def test_recfile_as_path(self):
         with mock.patch('__builtin__.open') as mopen:
             self.t.prepare_output_file('/path')
-            mopen.assert_called_once_with('/path', 'w')
+            mopen.assert_called_once_with('/path', 'wb')
 
     def test_recfile_as_file_obj(self):
         file_obj = os.tmpfile()
@@ -155,6 +185,33 @@ class RecordTransportFullTestCase(unittest.TestCase):
             if item:
                 assert item in contents, '%s not found in replay log' % item
 
+    def test_flush_every(self):
+        t = RecordTransport([{}], recfile=self.name, flush_every=2,
+                            connection_class=DummyConnection)
+        t.perform_request(*self.args)
+        with open(self.name, 'r') as rfile:
+            assert not rfile.read(), 'Request flushed before flush_every'
+        t.perform_request(*self.args)
+        with open(self.name, 'r') as rfile:
+            assert rfile.read().count(END) == 2
+
+    def test_buffered_requests_flushed_at_exit(self):
+        t = RecordTransport([{}], recfile=self.name, flush_every=2,
+                            connection_class=DummyConnection)
+        t.perform_request(*self.args)
+        flush_buffered_transports()
+        with open(self.name, 'r') as rfile:
+            assert rfile.read().count(END) == 1
+
+    def test_buffered_transport_can_be_collected(self):
+        t = RecordTransport([{}], recfile=self.name, flush_every=2,
+                            connection_class=DummyConnection)
+        assert t in _buffered_transports
+        ref = weakref.ref(t)
+        del t
+        gc.collect()
+        assert ref() is None
+
 
 class ReplayTransportTestCase(unittest.TestCase):
 
@@ -168,11 +225,118 @@ class ReplayTransportTestCase(unittest.TestCase):
         with self.assertRaises(ReplayFileParseError):
             t.get_next_replay('GET', '/', None, None)
 
+    def test_invalid_record_after_valid_ones(self):
+        t = self.get_instance(IN_CONTENTS + '#> odd\n#< 200\n##\n')
+        t.get_next_replay('GET', '/myindex', None, None)
+        t.get_next_replay('GET', '/myindex2', None, {"req": "body"})
+        with self.assertRaises(ReplayFileParseError):
+            t.get_next_replay('GET', '/', None, None)
+
     def test_different_request(self):
         t = self.get_instance(IN_CONTENTS)
         with self.assertRaises(RequestMatchError):
             t.get_next_replay('GET', '/badreq', None, None)
 
+    def test_replay_from_file(self):
+        replay_log = os.tmpfile()
+        replay_log.write(IN_CONTENTS)
+        t = ReplayTransport([{}], recfile=replay_log,
+                            connection_class=DummyConnection)
+        t.get_next_replay('GET', '/myindex', None, None)
+        status, data = t.get_next_replay('GET', '/myindex2', None,
+                                         {"req": "body"})
+        assert status == 200
+        assert {"key": "value2"} == data
+        with self.assertRaises(ReplayLogExceededError):
+            t.get_next_replay('GET', '/myindex', None, None)
+
+    def test_replay_from_gzip_file(self):
+        name = os.tmpnam()
+        with gzip.open(name, 'wb') as f:
+            f.write(IN_CONTENTS)
+        t = ReplayTransport([{}], recfile=gzip.open(name, 'rb'),
+                            connection_class=DummyConnection)
+        status, data = t.get_next_replay('GET', '/myindex', None, None)
+        assert status == 200
+        assert {"key": "value"} == data
+        os.remove(name)
+
+    def test_replay_from_empty_file(self):
+        t = ReplayTransport([{}], recfile=os.tmpfile(),
+                            connection_class=DummyConnection)
+        with self.assertRaises(ReplayLogExceededError):
+            t.get_next_replay('GET', '/myindex', None, None)
+
+    def test_reset_replay_log_reuses_parsed_records(self):
+        name = os.tmpnam()
+        with open(name, 'wb') as f:
+            f.write(IN_CONTENTS)
+        t = ReplayTransport([{}], recfile=name,
+                            connection_class=DummyConnection)
+        t.get_next_replay('GET', '/myindex', None, None)
+        t.reset_replay_log()
+        t.create_replay_iterator = mock.Mock()
+        t.get_next_replay('GET', '/myindex', None, None)
+        assert not t.create_replay_iterator.called
+        os.remove(name)
+
+    def test_reset_replay_log_after_file_rewritten_at_same_size(self):
+        name = os.tmpnam()
+        replay_log = open(name, 'w+b')
+        replay_log.write(IN_CONTENTS)
+        replay_log.flush()
+        # Whole second mtimes as on filesystems with coarse timestamps
+        os.utime(name, (1400000000, 1400000000))
+        t = ReplayTransport([{}], recfile=replay_log,
+                            connection_class=DummyConnection)
+        t.get_next_replay('GET', '/myindex', None, None)
+        replay_log.seek(0)
+        replay_log.truncate()
+        replay_log.write(IN_CONTENTS.replace('/myindex2', '/myindex3'))
+        replay_log.flush()
+        os.utime(name, (1400000000, 1400000000))
+        t.reset_replay_log()
+        t.get_next_replay('GET', '/myindex', None, None)
+        status, data = t.get_next_replay('GET', '/myindex3', None,
+                                         {"req": "body"})
+        assert status == 200
+        assert {"key": "value2"} == data
+
+    def test_reset_replay_log_response_mutation_doesnt_leak(self):
+        replay_log = os.tmpfile()
+        replay_log.write(IN_CONTENTS)
+        t = ReplayTransport([{}], recfile=replay_log,
+                            connection_class=DummyConnection)
+        status, data = t.perform_request('GET', '/myindex')
+        data.pop('key')
+        t.reset_replay_log()
+        status, data = t.perform_request('GET', '/myindex')
+        assert {"key": "value"} == data
+
+    def test_reset_replay_log_after_file_changed(self):
+        replay_log = os.tmpfile()
+        replay_log.write(IN_CONTENTS)
+        t = ReplayTransport([{}], recfile=replay_log,
+                            connection_class=DummyConnection)
+        t.get_next_replay('GET', '/myindex', None, None)
+        replay_log.seek(0)
+        replay_log.truncate()
+        replay_log.write(IN_SCROLL)
+        t.reset_replay_log()
+        status, data = t.get_next_replay('POST', '/_search/scroll',
+                                         {'scroll': '5m'},
+                                         'c2NhbjswOzE7dG90YWxfaGl0czoxMDA7')
+        assert status == 200
+        assert '_scroll_id' in data
+
+    def test_end_marker_like_line_ending(self):
+        t = self.get_instance('#> POST /_search/scroll -\n#> c2Nhbj##\n'
+                              '#< 200\n#< {"key": "value"}\n##\n')
+        status, data = t.get_next_replay('POST', '/_search/scroll', None,
+                                         'c2Nhbj##')
+        assert status == 200
+        assert {"key": "value"} == data
+
 
 class ReplayTransportFullTestCase(unittest.TestCase):
 
@@ -229,6 +393,27 @@ def test_non_deserializable_body():
     assert '_scroll_id' in data
 
 
+def test_json_scalar_body_matches_recorded_one():
+    f = StringIO.StringIO('#> POST /_search/scroll -\n#> 12345\n'
+                          '#< 200\n#< {"key": "value"}\n##\n')
+    t = ReplayTransport([{}], recfile=f, connection_class=DummyConnection)
+    status, data = t.perform_request('POST', '/_search/scroll', body='12345')
+    assert status == 200
+
+
+def test_falsy_body_matches_recorded_one():
+    f = StringIO.StringIO()
+    t = RecordTransport([{}], recfile=f, connection_class=DummyConnection)
+    for body in (0, False):
+        t.perform_request('POST', '/_search', body=body)
+    t.flush()
+    f = StringIO.StringIO(f.getvalue())
+    t = ReplayTransport([{}], recfile=f, connection_class=DummyConnection)
+    for body in (0, False):
+        status, data = t.perform_request('POST', '/_search', body=body)
+        assert status == 200
+
+
 def test_non_deserializable_elements_in_body():
     import datetime
     body = {